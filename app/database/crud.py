@@ -0,0 +1,32 @@
+from datetime import datetime, timezone
+from typing import List
+import msgspec
+from sqlalchemy import insert, text
+from .models import SecurityLogRecord
+from .session import AsyncSessionLocal, engine
+from ..models import SecurityLog
+
+# Chiave dell'advisory lock che serializza la creazione della tabella tra i worker
+_SECURITY_LOGS_DDL_LOCK = 0x5EC0106
+
+async def create_security_logs_table():
+    """Crea la tabella security_logs se manca (solo questa, non l'intero schema)"""
+    async with engine.begin() as conn:
+        # Più worker all'avvio: il lock evita CREATE TABLE/INDEX concorrenti
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _SECURITY_LOGS_DDL_LOCK})
+        await conn.run_sync(SecurityLogRecord.__table__.create, checkfirst=True)
+
+async def insert_security_logs(logs: List[SecurityLog]):
+    """Salva un batch di log di sicurezza con un'unica INSERT multi-riga"""
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            insert(SecurityLogRecord),
+            [
+                {
+                    **msgspec.structs.asdict(log),
+                    "timestamp": datetime.fromtimestamp(log.timestamp, tz=timezone.utc)
+                }
+                for log in logs
+            ]
+        )
+        await session.commit()
@@ -1,10 +1,11 @@
-from sqlalchemy import Column, String, DateTime, Float, Boolean, ForeignKey, JSON
-from sqlalchemy.dialects.postgresql import UUID, ARRAY
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, String, DateTime, Float, Boolean, ForeignKey, Index
+from sqlalchemy.dialects.postgresql import UUID, JSONB
+from sqlalchemy.orm import DeclarativeBase
 import uuid
 from datetime import datetime
 
-Base = declarative_base()
+class Base(DeclarativeBase):
+    pass
 
 class User(Base):
     __tablename__ = 'users'
@@ -17,7 +18,7 @@ class User(Base):
 class APIKey(Base):
     __tablename__ = 'api_keys'
     key_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    user_id = Column(UUID(as_uuid=True), ForeignKey('users.user_id'))
+    user_id = Column(UUID(as_uuid=True), ForeignKey('users.user_id'), index=True)
     api_key = Column(String, unique=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     expires_at = Column(DateTime)
@@ -25,9 +26,12 @@ class APIKey(Base):
 
 class Sample(Base):
     __tablename__ = 'samples'
+    __table_args__ = (
+        Index('ix_samples_user_ts', 'user_id', 'timestamp'),
+    )
     sample_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    user_id = Column(UUID(as_uuid=True), ForeignKey('users.user_id'))
-    timestamp = Column(DateTime)
+    user_id = Column(UUID(as_uuid=True), ForeignKey('users.user_id'))  # coperto da ix_samples_user_ts
+    timestamp = Column(DateTime, index=True)
     latitude = Column(Float)
     longitude = Column(Float)
     altitude = Column(Float)
@@ -38,11 +42,23 @@ class Sample(Base):
 
 class MicrobiomeAnalysis(Base):
     __tablename__ = 'microbiome_analysis'
+    __table_args__ = (
+        Index('ix_mb_health_gin', 'health_indicators', postgresql_using='gin'),
+    )
     analysis_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    sample_id = Column(UUID(as_uuid=True), ForeignKey('samples.sample_id'))
+    sample_id = Column(UUID(as_uuid=True), ForeignKey('samples.sample_id'), index=True)
     biodiversity_index = Column(Float)
-    dominant_species = Column(JSON)
-    health_indicators = Column(JSON)
-    recommendations = Column(ARRAY(String))
-    external_data = Column(JSON)
-    created_at = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    dominant_species = Column(JSONB)
+    health_indicators = Column(JSONB)
+    recommendations = Column(JSONB)
+    external_data = Column(JSONB)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class SecurityLogRecord(Base):
+    __tablename__ = 'security_logs'
+    log_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    timestamp = Column(DateTime(timezone=True), index=True)
+    event_type = Column(String)
+    user_id = Column(String)
+    ip_address = Column(String)
+    details = Column(String)
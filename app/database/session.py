@@ -0,0 +1,33 @@
+import os
+from typing import Optional
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+
+# Schemi Postgres sincroni (o senza driver) riscritti verso asyncpg
+_SYNC_POSTGRES_DRIVERS = {"postgres", "postgresql", "postgresql+psycopg2", "postgresql+pg8000"}
+
+def _async_database_url(url: str) -> str:
+    """Converte l'URL Postgres nel formato richiesto dal driver asyncpg"""
+    parsed = make_url(url)
+    if parsed.drivername in _SYNC_POSTGRES_DRIVERS:
+        parsed = parsed.set(drivername="postgresql+asyncpg")
+    elif parsed.drivername != "postgresql+asyncpg":
+        # Meglio fallire all'avvio che al primo utilizzo del motore asincrono
+        raise ValueError(f"Unsupported DATABASE_URL driver: {parsed.drivername}")
+    return parsed.render_as_string(hide_password=False)
+
+# Il database è opzionale: senza DATABASE_URL non viene creato alcun motore
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+engine: Optional[AsyncEngine] = None
+AsyncSessionLocal: Optional[async_sessionmaker] = None
+if DATABASE_URL:
+    # Pool di connessioni condiviso: nessun handshake TCP/TLS per richiesta
+    engine = create_async_engine(
+        _async_database_url(DATABASE_URL),
+        pool_size=20,
+        max_overflow=10,
+        pool_pre_ping=True,
+        pool_recycle=3600
+    )
+    AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False)
@@ -1,8 +1,16 @@
 import os
+import asyncio
+import logging
+import hashlib
+import time
+import orjson
 import stripe
-from fastapi import FastAPI, HTTPException, Depends, Security, Request
+import redis.asyncio as aioredis
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, Security, Request, Response
+from fastapi.responses import ORJSONResponse
 from fastapi.security.api_key import APIKeyHeader, APIKey
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import Dict, Optional
 from .models import (
    SampleData, 
@@ -12,12 +20,91 @@ from .models import (
    PaymentIntent,
    SubscriptionResponse,
    APIKeyModel,
-   APIKeyResponse,
-   SecurityLog
+   APIKeyResponse
 )
-from .utils.analysis import analyze_microbiome_sample
+from .database.crud import create_security_logs_table, insert_security_logs
+from .database.session import engine
+from .utils.analysis import analyze_microbiome_batch
 from .utils.security import SecurityConfig, RateLimiter, APIKeyManager
-from .utils.monitoring import SecurityMonitor, PerformanceMonitor
+from .utils.external_apis import ExternalAPIsManager
+from .utils.monitoring import (
+   AuditLogFile,
+   SecurityMonitor,
+   PerformanceMonitor,
+   SAMPLES_ANALYZED,
+   get_samples_analyzed
+)
+
+# Configurazione logging (unica per tutta l'applicazione)
+logging.basicConfig(
+   level=logging.INFO,
+   format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+_UTC = timezone.utc
+_KEY_LIFETIME = timedelta(days=365)  # validità delle API key generate
+
+# Batching delle analisi: le richieste concorrenti vengono raccolte ed elaborate insieme
+BATCH_MAX = 64
+BATCH_WINDOW = 0.005  # secondi
+
+analysis_queue: Optional[asyncio.Queue] = None
+
+async def analysis_worker(queue: asyncio.Queue):
+   """Raccoglie i campioni in coda e li analizza a batch"""
+   while True:
+       batch = [await queue.get()]
+
+       # Attende brevemente altri campioni prima di elaborare il batch
+       if queue.empty():
+           await asyncio.sleep(BATCH_WINDOW)
+       while len(batch) < BATCH_MAX and not queue.empty():
+           batch.append(queue.get_nowait())
+
+       try:
+           results = analyze_microbiome_batch([sample for sample, _ in batch])
+       except Exception as e:
+           for _, future in batch:
+               if not future.done():
+                   future.set_exception(e)
+           continue
+
+       for (_, future), result in zip(batch, results):
+           if not future.done():
+               future.set_result(result)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+   """Avvia e arresta i task in background dell'applicazione"""
+   global analysis_queue
+   if insert_security_logs in security_log_sinks:
+       await create_security_logs_table()
+   analysis_queue = asyncio.Queue()
+   tasks = [
+       asyncio.create_task(analysis_worker(analysis_queue)),
+       asyncio.create_task(api_key_manager.run())
+   ]
+   log_writer = asyncio.create_task(security_monitor.run())
+   try:
+       yield
+   finally:
+       try:
+           for task in tasks:
+               task.cancel()
+           await asyncio.gather(*tasks, return_exceptions=True)
+           # Il writer dei log non viene cancellato: si ferma con una sentinella,
+           # così nessun batch in scrittura va perso per le destinazioni
+           await security_monitor.stop()
+           await log_writer
+       finally:
+           if audit_log is not None:
+               audit_log.close()
+           await external_apis.close()
+           if engine is not None:
+               await engine.dispose()
+           if redis_client is not None:
+               await redis_client.aclose()
 
 # Configurazione FastAPI
 app = FastAPI(
@@ -27,19 +114,38 @@ app = FastAPI(
    contact={
        "name": "Support Team",
        "email": "support@example.com"
-   }
+   },
+   default_response_class=ORJSONResponse,
+   lifespan=lifespan
 )
 
+# Redis (opzionale) per lo stato condiviso tra worker
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+
 # Inizializzazione componenti di sicurezza
 security_config = SecurityConfig()
-rate_limiter = RateLimiter()
+rate_limiter = RateLimiter(redis_client)
 api_key_manager = APIKeyManager()
-security_monitor = SecurityMonitor()
+# I log di sicurezza vengono salvati a batch su database e/o file di audit,
+# se configurati
+SECURITY_AUDIT_LOG = os.getenv("SECURITY_AUDIT_LOG")
+audit_log = AuditLogFile(SECURITY_AUDIT_LOG) if SECURITY_AUDIT_LOG else None
+security_log_sinks = []
+if engine is not None:
+   security_log_sinks.append(insert_security_logs)
+if audit_log is not None:
+   security_log_sinks.append(audit_log)
+security_monitor = SecurityMonitor(sinks=security_log_sinks)
 performance_monitor = PerformanceMonitor()
+external_apis = ExternalAPIsManager()
 
 # Configurazione Stripe
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 
+# Durata della deduplica degli eventi webhook (secondi)
+STRIPE_EVENT_TTL = 86400
+
 # ID Prezzi Stripe
 STRIPE_PRICE_IDS = {
    PlanTier.BASIC: "price_ID_basic",
@@ -87,10 +193,32 @@ PRICING_PLANS = {
    )
 }
 
-# Statistiche globali
+# Risposta statica di /api/v1/plans, serializzata una sola volta
+_PLANS_BYTES = orjson.dumps({
+   "plans": {
+       tier.value: plan.model_dump(mode="json")
+       for tier, plan in PRICING_PLANS.items()
+   }
+})
+_PLANS_ETAG = '"' + hashlib.sha256(_PLANS_BYTES).hexdigest()[:16] + '"'
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+   """Confronto debole di If-None-Match (lista di ETag separati da virgole o "*")"""
+   if not if_none_match:
+       return False
+   for candidate in if_none_match.split(","):
+       candidate = candidate.strip()
+       if candidate == "*":
+           return True
+       if candidate.startswith("W/"):
+           candidate = candidate[2:]
+       if candidate == etag:
+           return True
+   return False
+
+# Statistiche globali (il totale dei campioni è in SAMPLES_ANALYZED)
 stats = {
-   "total_samples_analyzed": 0,
-   "last_analysis": None
+   "last_analysis": None  # epoch (time.time()), convertito solo in risposta
 }
 
 # Configurazione API Key
@@ -101,10 +229,10 @@ api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
 @app.middleware("http")
 async def monitoring_middleware(request: Request, call_next):
    """Middleware per monitorare le performance e la sicurezza delle richieste"""
-   start_time = datetime.utcnow()
+   start_ns = time.monotonic_ns()
    
    # Log della richiesta iniziale
-   await security_monitor.log_request(
+   security_monitor.log_request(
        request,
        "system",
        "request_started",
@@ -112,7 +240,7 @@ async def monitoring_middleware(request: Request, call_next):
    )
    
    response = await call_next(request)
-   duration = (datetime.utcnow() - start_time).total_seconds()
+   duration = (time.monotonic_ns() - start_ns) / 1e9
    
    # Registra performance
    await performance_monitor.record_request(duration, response.status_code)
@@ -126,7 +254,7 @@ async def get_api_key(
 ) -> APIKeyModel:
    """Valida l'API key e gestisce l'autenticazione"""
    if not api_key_header:
-       await security_monitor.log_request(
+       security_monitor.log_request(
            request, 
            "unknown", 
            "authentication_failed", 
@@ -149,36 +277,39 @@ async def get_api_key(
    return key_data
 
 # Endpoints
+_ROOT_BYTES = orjson.dumps({
+   "name": "Urban Microbiome API",
+   "version": "1.0.0",
+   "description": "Secure API for analyzing urban microbiome samples",
+   "endpoints": {
+       "docs": "/docs",
+       "health": "/api/v1/health",
+       "analyze": "/api/v1/analyze",
+       "stats": "/api/v1/stats",
+       "plans": "/api/v1/plans",
+       "subscribe": "/api/v1/subscribe",
+       "key": "/api/v1/key"
+   }
+})
+
 @app.get("/")
 async def root():
    """Endpoint root con informazioni base dell'API"""
-   return {
-       "name": "Urban Microbiome API",
-       "version": "1.0.0",
-       "description": "Secure API for analyzing urban microbiome samples",
-       "endpoints": {
-           "docs": "/docs",
-           "health": "/api/v1/health",
-           "analyze": "/api/v1/analyze",
-           "stats": "/api/v1/stats",
-           "plans": "/api/v1/plans",
-           "subscribe": "/api/v1/subscribe",
-           "key": "/api/v1/key"
-       }
-   }
+   return Response(content=_ROOT_BYTES, media_type="application/json")
 
 @app.get("/api/v1/health")
 async def health_check():
    """Endpoint per verificare lo stato dell'API"""
-   return {
+   return ORJSONResponse({
        "status": "healthy",
-       "timestamp": datetime.utcnow(),
+       "timestamp": datetime.now(_UTC),
        "version": "1.0.0",
        "performance": {
            "average_response_time": performance_monitor.get_average_response_time(),
+           "p99_response_time": performance_monitor.get_p99(),
            "error_rate": performance_monitor.get_error_rate()
        }
-   }
+   })
 
 @app.post("/api/v1/analyze", response_model=AnalysisResult)
 async def analyze_sample(
@@ -188,8 +319,8 @@ async def analyze_sample(
 ):
    """Endpoint principale per l'analisi dei campioni"""
    # Verifica rate limit
-   if not await rate_limiter.check_rate_limit(api_key.key, api_key_manager.api_keys):
-       await security_monitor.log_request(
+   if not await rate_limiter.check_rate_limit(api_key):
+       security_monitor.log_request(
            request,
            api_key.user_id,
            "rate_limit_exceeded",
@@ -202,24 +333,27 @@ async def analyze_sample(
 
    try:
        # Cripta dati sensibili
-       encrypted_location = security_config.encrypt_data(data.location.json())
+       encrypted_location = security_config.encrypt_data(data.location.model_dump_json())
        
-       result = analyze_microbiome_sample(data)
+       future = asyncio.get_running_loop().create_future()
+       await analysis_queue.put((data, future))
+       result = await future
        
        # Aggiorna statistiche
-       stats["total_samples_analyzed"] += 1
-       stats["last_analysis"] = datetime.utcnow()
+       SAMPLES_ANALYZED.inc()
+       stats["last_analysis"] = time.time()
        
-       await security_monitor.log_request(
+       security_monitor.log_request(
            request,
            api_key.user_id,
            "analysis_success",
            f"Sample: {data.sample_id}"
        )
        
-       return result
+       # Il risultato è già validato: response_model resta solo per la documentazione
+       return Response(content=result.model_dump_json(), media_type="application/json")
    except Exception as e:
-       await security_monitor.log_request(
+       security_monitor.log_request(
            request,
            api_key.user_id,
            "analysis_error",
@@ -233,20 +367,28 @@ async def analyze_sample(
 @app.get("/api/v1/stats")
 async def get_stats(api_key: APIKeyModel = Depends(get_api_key)):
    """Endpoint per le statistiche di utilizzo"""
+   last_analysis = stats["last_analysis"]
    return {
-       "total_samples_analyzed": stats["total_samples_analyzed"],
-       "last_analysis": stats["last_analysis"],
+       "total_samples_analyzed": get_samples_analyzed(),
+       "last_analysis": (
+           datetime.fromtimestamp(last_analysis, tz=_UTC)
+           if last_analysis is not None else None
+       ),
        "api_version": "1.0.0",
        "performance_metrics": {
            "average_response_time": performance_monitor.get_average_response_time(),
+           "p99_response_time": performance_monitor.get_p99(),
            "error_rate": performance_monitor.get_error_rate()
        }
    }
 
 @app.get("/api/v1/plans")
-async def get_plans():
+async def get_plans(request: Request):
    """Endpoint per visualizzare i piani disponibili"""
-   return {"plans": PRICING_PLANS}
+   headers = {"ETag": _PLANS_ETAG}
+   if _etag_matches(request.headers.get("if-none-match"), _PLANS_ETAG):
+       return Response(status_code=304, headers=headers)
+   return Response(content=_PLANS_BYTES, media_type="application/json", headers=headers)
 
 @app.post("/api/v1/subscribe", response_model=SubscriptionResponse)
 async def create_subscription(
@@ -255,7 +397,9 @@ async def create_subscription(
 ):
    """Endpoint per la creazione di nuove sottoscrizioni"""
    try:
-       session = stripe.checkout.Session.create(
+       # L'SDK Stripe è sincrono: la chiamata HTTP gira in un thread del pool
+       session = await asyncio.to_thread(
+           stripe.checkout.Session.create,
            payment_method_types=['card'],
            line_items=[{
                'price': STRIPE_PRICE_IDS[payment.plan],
@@ -267,7 +411,7 @@ async def create_subscription(
            cancel_url=f"{request.base_url}api/v1/cancel"
        )
        
-       await security_monitor.log_request(
+       security_monitor.log_request(
            request,
            "system",
            "subscription_created",
@@ -279,7 +423,7 @@ async def create_subscription(
            session_id=session.id
        )
    except Exception as e:
-       await security_monitor.log_request(
+       security_monitor.log_request(
            request,
            "system",
            "subscription_error",
@@ -299,7 +443,7 @@ async def generate_key(
    """Endpoint per la generazione di nuove API key"""
    try:
        api_key = api_key_manager.generate_api_key(user_id, plan)
-       await security_monitor.log_request(
+       security_monitor.log_request(
            request,
            user_id,
            "api_key_generated",
@@ -307,10 +451,10 @@ async def generate_key(
        )
        return APIKeyResponse(
            key=api_key,
-           expires_at=datetime.utcnow().replace(year=datetime.utcnow().year + 1)
+           expires_at=datetime.now(_UTC) + _KEY_LIFETIME
        )
    except Exception as e:
-       await security_monitor.log_request(
+       security_monitor.log_request(
            request,
            user_id,
            "api_key_generation_error",
@@ -324,25 +468,44 @@ async def generate_key(
 @app.post("/api/v1/webhook")
 async def stripe_webhook(request: Request):
    """Webhook per gestire gli eventi Stripe"""
+   event_key = None
    try:
-       event = stripe.Webhook.construct_event(
-           payload=await request.body(),
+       body = await request.body()
+       # construct_event serve solo per la verifica della firma: i campi
+       # necessari si leggono dal payload grezzo senza costruire lo stripe.Event
+       await asyncio.to_thread(
+           stripe.Webhook.construct_event,
+           payload=body,
            sig_header=request.headers.get('stripe-signature'),
            secret=os.getenv("STRIPE_WEBHOOK_SECRET")
        )
+       event = orjson.loads(body)
+
+       # Stripe ripete le consegne: ogni evento viene elaborato una sola volta
+       if redis_client is not None:
+           event_key = f"stripe:evt:{event['id']}"
+           if not await redis_client.set(event_key, "1", nx=True, ex=STRIPE_EVENT_TTL):
+               return {"status": "duplicate"}
        
-       if event.type == 'checkout.session.completed':
-           session = event.data.object
-           await security_monitor.log_request(
+       if event["type"] == 'checkout.session.completed':
+           session = event["data"]["object"]
+           security_monitor.log_request(
                request,
-               session.customer_email,
+               session.get("customer_email"),
                "payment_completed",
-               f"Session: {session.id}"
+               f"Session: {session['id']}"
            )
        
        return {"status": "success"}
    except Exception as e:
-       await security_monitor.log_request(
+       # Rilascia la chiave così la riconsegna di Stripe rielabora l'evento
+       if event_key is not None:
+           try:
+               await redis_client.delete(event_key)
+           except Exception:
+               # Non deve mascherare l'errore originale dell'evento
+               logger.exception("Failed to release Stripe event key %s", event_key)
+       security_monitor.log_request(
            request,
            "system",
            "webhook_error",
@@ -374,17 +537,20 @@ async def payment_cancel():
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
    """Handler globale per le eccezioni"""
-   await security_monitor.log_request(
+   security_monitor.log_request(
        request,
        "system",
        "global_error",
        str(exc)
    )
-   return {
-       "error": "Internal Server Error",
-       "detail": str(exc),
-       "timestamp": datetime.utcnow()
-   }
+   return ORJSONResponse(
+       status_code=500,
+       content={
+           "error": "Internal Server Error",
+           "detail": str(exc),
+           "timestamp": datetime.now(_UTC)
+       }
+   )
 
 if __name__ == "__main__":
    import uvicorn
@@ -1,4 +1,5 @@
-from pydantic import BaseModel, EmailStr
+import msgspec
+from pydantic import BaseModel, ConfigDict, EmailStr
 from typing import List, Dict, Optional
 from datetime import datetime
 from enum import Enum
@@ -11,12 +12,16 @@ class PlanTier(str, Enum):
 
 # Modelli base per l'analisi
 class Location(BaseModel):
+    model_config = ConfigDict(extra='ignore', frozen=True)
+
     latitude: float
     longitude: float
     altitude: float
     location_type: str
 
 class SampleData(BaseModel):
+    model_config = ConfigDict(extra='ignore', frozen=True)
+
     sample_id: str
     timestamp: datetime
     location: Location
@@ -25,6 +30,8 @@ class SampleData(BaseModel):
     metadata: Dict[str, str]
 
 class AnalysisResult(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     sample_id: str
     biodiversity_index: float
     dominant_species: List[str]
@@ -33,35 +40,60 @@ class AnalysisResult(BaseModel):
 
 # Modelli per la gestione dei pagamenti
 class SubscriptionPlan(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     tier: PlanTier
     price_monthly: float
     requests_limit: int
     features: List[str]
 
 class PaymentIntent(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     plan: PlanTier
     customer_email: EmailStr
 
 class SubscriptionResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     checkout_url: str
     session_id: str
 
+class SubscriptionUsage(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    requests_used: int
+    requests_limit: int
+    remaining_requests: int
+    days_until_renewal: int
+
+# Stato interno (non esposto dalle API): msgspec.Struct immutabili, con slot
+# e costruzione in C. Gli aggiornamenti passano da msgspec.structs.replace.
+# Gli istanti sono epoch float (time.time()): i datetime si creano solo in risposta
+class UserSubscription(msgspec.Struct, frozen=True):
+    user_id: str
+    plan: PlanTier
+    requests_used: int
+    current_period_end_ts: float
+
 # Modelli per la sicurezza e autenticazione
-class APIKeyModel(BaseModel):
+class APIKeyModel(msgspec.Struct, frozen=True):
     key: str
     user_id: str
     plan: PlanTier
-    created_at: datetime
+    created_at: float
     is_active: bool
-    last_used: Optional[datetime]
+    last_used: Optional[float]
     requests_count: int = 0
 
 class APIKeyResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     key: str
     expires_at: datetime
 
-class SecurityLog(BaseModel):
-    timestamp: datetime
+class SecurityLog(msgspec.Struct, frozen=True):
+    timestamp: float
     event_type: str
     user_id: str
     ip_address: Optional[str]
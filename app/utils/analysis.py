@@ -1,31 +1,88 @@
 import numpy as np
 from datetime import datetime
+from typing import List
 from ..models import SampleData, AnalysisResult
 
-def analyze_microbiome_sample(sample: SampleData) -> AnalysisResult:
-    # Simulazione analisi
-    biodiversity = np.random.uniform(0.5, 1.0)
-    
+try:
+    from numba import njit
+except ImportError:  # numba è opzionale: senza, il kernel gira in NumPy puro
+    njit = None
+
+# Generatore condiviso: un'unica estrazione per batch invece di una per campione
+_rng = np.random.default_rng()
+
+DOMINANT_SPECIES = [
+    "Lactobacillus",
+    "Bifidobacterium",
+    "Bacillus subtilis"
+]
+
+RECOMMENDATIONS = [
+    "Increase green spaces",
+    "Improve ventilation",
+    "Monitor humidity levels"
+]
+
+def _compute_indicators(temp, humidity, biodiv, r1, r2, r3):
+    """Calcola gli indicatori di salute (scalari o array NumPy)"""
+    temp_factor = 1 - np.abs(temp - 20) / 30  # ottimale a 20°C
+    humidity_factor = 1 - np.abs(humidity - 60) / 60  # ottimale al 60%
+
+    air_quality = (60 + 40 * r1) * temp_factor
+    pathogen_risk = 10 * r2 * (1 - humidity_factor)
+    environmental_stress = 100 * r3 * (1 - biodiv)
+    return air_quality, pathogen_risk, environmental_stress
+
+if njit is not None:
+    _compute_indicators = njit(cache=True, fastmath=True)(_compute_indicators)
+    # Precompilazione all'import, così la prima richiesta non paga il JIT
+    _warmup = np.zeros(1)
+    _compute_indicators(_warmup, _warmup, _warmup, _warmup, _warmup, _warmup)
+    del _warmup
+
+def analyze_microbiome_batch(samples: List[SampleData]) -> List[AnalysisResult]:
+    """Analizza un batch di campioni con operazioni vettoriali"""
+    n = len(samples)
+    if n == 0:
+        return []
+
+    temperature = np.asarray([s.temperature for s in samples], dtype=np.float64)
+    humidity = np.asarray([s.humidity for s in samples], dtype=np.float64)
+    draws = _rng.random(size=(4, n))  # righe contigue per il kernel
+
+    # Simulazione analisi (l'estrazione resta in NumPy: l'RNG di numba è diverso)
+    biodiversity = 0.5 + 0.5 * draws[0]
+
     # Calcolo indicatori di salute basati su temperatura e umidità
-    temp_factor = 1 - abs(sample.temperature - 20) / 30  # ottimale a 20°C
-    humidity_factor = 1 - abs(sample.humidity - 60) / 60  # ottimale al 60%
-    
-    return AnalysisResult(
-        sample_id=sample.sample_id,
-        biodiversity_index=biodiversity,
-        dominant_species=[
-            "Lactobacillus",
-            "Bifidobacterium",
-            "Bacillus subtilis"
-        ],
-        health_indicators={
-            "air_quality": np.random.uniform(60, 100) * temp_factor,
-            "pathogen_risk": np.random.uniform(0, 10) * (1 - humidity_factor),
-            "environmental_stress": np.random.uniform(0, 100) * (1 - biodiversity)
-        },
-        recommendations=[
-            "Increase green spaces",
-            "Improve ventilation",
-            "Monitor humidity levels"
-        ]
-    )
\ No newline at end of file
+    air_quality, pathogen_risk, environmental_stress = _compute_indicators(
+        temperature,
+        humidity,
+        biodiversity,
+        draws[1],
+        draws[2],
+        draws[3]
+    )
+
+    return [
+        AnalysisResult(
+            sample_id=sample.sample_id,
+            biodiversity_index=bio,
+            dominant_species=list(DOMINANT_SPECIES),
+            health_indicators={
+                "air_quality": aq,
+                "pathogen_risk": pr,
+                "environmental_stress": es
+            },
+            recommendations=list(RECOMMENDATIONS)
+        )
+        for sample, bio, aq, pr, es in zip(
+            samples,
+            biodiversity.tolist(),
+            air_quality.tolist(),
+            pathogen_risk.tolist(),
+            environmental_stress.tolist()
+        )
+    ]
+
+def analyze_microbiome_sample(sample: SampleData) -> AnalysisResult:
+    return analyze_microbiome_batch([sample])[0]
@@ -1,7 +1,37 @@
-import aiohttp
+import asyncio
+import httpx
+import orjson
 import os
-from typing import Dict, Any
-from datetime import datetime
+from typing import Dict, Any, Hashable, List, Optional
+from cachetools import TTLCache
+
+# Richieste concorrenti massime verso ciascun servizio esterno
+HOST_CONCURRENCY = 10
+# Tempo massimo complessivo (secondi) per ogni richiesta esterna
+REQUEST_TIMEOUT = 30
+
+# Cache delle risposte (secondi): meteo e qualità dell'aria cambiano nell'arco
+# di minuti, la tassonomia NCBI praticamente mai
+CACHE_TTL = {
+    'openweather': 600,
+    'airquality': 600,
+    'ncbi': 86400
+}
+CACHE_MAXSIZE = 4096
+# Gli errori restano in cache per poco, per non martellare un servizio
+# esterno in difficoltà
+NEGATIVE_CACHE_TTL = 60
+# Coordinate arrotondate (~1 km) per aumentare gli hit di cache
+COORD_PRECISION = 2
+
+class ExternalAPIError(Exception):
+    """Errore di un servizio esterno, senza URL né chiavi API nel messaggio"""
+
+    def __init__(self, service: str, status_code: Optional[int] = None, reason: str = ""):
+        self.service = service
+        self.status_code = status_code
+        detail = f"HTTP {status_code}" if status_code is not None else reason
+        super().__init__(f"{service}: {detail}")
 
 class ExternalAPIsManager:
     def __init__(self):
@@ -10,26 +40,83 @@ class ExternalAPIsManager:
             'airquality': os.getenv('AIRQUALITY_API_KEY'),
             'ncbi': os.getenv('NCBI_API_KEY')
         }
-        
+        self._client: Optional[httpx.AsyncClient] = None
+        self._host_sems: Dict[str, asyncio.Semaphore] = {}
+        self._cache = {
+            service: TTLCache(maxsize=CACHE_MAXSIZE, ttl=ttl)
+            for service, ttl in CACHE_TTL.items()
+        }
+        self._negative_cache = TTLCache(maxsize=CACHE_MAXSIZE, ttl=NEGATIVE_CACHE_TTL)
+
+    async def _get_client(self) -> httpx.AsyncClient:
+        """Restituisce il client HTTP/2 condiviso, creandolo al primo utilizzo"""
+        if self._client is None or self._client.is_closed:
+            # HTTP/2: le richieste concorrenti verso lo stesso host condividono
+            # una sola connessione TLS
+            self._client = httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+                timeout=httpx.Timeout(30, connect=5)
+            )
+        return self._client
+
+    async def _fetch(self, service: str, cache_key: Hashable, url: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """Esegue una GET verso un servizio esterno, con cache e limite di concorrenza"""
+        cache = self._cache[service]
+        if cache_key in cache:
+            return cache[cache_key]
+        # In cache solo (status, motivo): un'eccezione condivisa accumulerebbe
+        # traceback e terrebbe vivi i frame con i parametri (e le chiavi API)
+        failure = self._negative_cache.get((service, cache_key))
+        if failure is not None:
+            raise ExternalAPIError(service, *failure) from None
+
+        # Semafori creati al primo uso, all'interno dell'event loop in esecuzione
+        sem = self._host_sems.get(service)
+        if sem is None:
+            sem = self._host_sems[service] = asyncio.Semaphore(HOST_CONCURRENCY)
+        client = await self._get_client()
+        try:
+            async with sem:
+                # Timeout dell'intera richiesta: quelli di httpx valgono per singola operazione
+                response = await asyncio.wait_for(client.get(url, params=params), REQUEST_TIMEOUT)
+            response.raise_for_status()
+            data = orjson.loads(response.content)
+        except httpx.HTTPStatusError as e:
+            failure = (e.response.status_code, "")
+        except (httpx.HTTPError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+            failure = (None, type(e).__name__)
+        else:
+            cache[cache_key] = data
+            return data
+
+        # L'errore originale contiene l'URL con le chiavi API: non va propagato
+        self._negative_cache[(service, cache_key)] = failure
+        raise ExternalAPIError(service, *failure) from None
+
+    async def close(self):
+        """Chiude il client HTTP condiviso"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
     async def get_weather_data(self, lat: float, lon: float) -> Dict[str, Any]:
+        lat, lon = round(lat, COORD_PRECISION), round(lon, COORD_PRECISION)
         url = f"https://api.openweathermap.org/data/2.5/air_pollution"
         params = {
             'lat': lat,
             'lon': lon,
             'appid': self.api_keys['openweather']
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params) as response:
-                return await response.json()
+        return await self._fetch('openweather', (lat, lon), url, params)
 
     async def get_air_quality(self, lat: float, lon: float) -> Dict[str, Any]:
+        lat, lon = round(lat, COORD_PRECISION), round(lon, COORD_PRECISION)
         url = f"https://api.waqi.info/feed/geo:{lat};{lon}/"
         params = {
             'token': self.api_keys['airquality']
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params) as response:
-                return await response.json()
+        return await self._fetch('airquality', (lat, lon), url, params)
 
     async def get_microbiome_data(self, taxa: str) -> Dict[str, Any]:
         url = "https://api.ncbi.nlm.nih.gov/datasets/v2alpha/taxonomy/taxon"
@@ -37,6 +124,13 @@ class ExternalAPIsManager:
             'api_key': self.api_keys['ncbi'],
             'taxon': taxa
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params) as response:
-                return await response.json()
\ No newline at end of file
+        return await self._fetch('ncbi', taxa, url, params)
+
+    async def fetch_all(self, lat: float, lon: float, taxa: str) -> List[Any]:
+        """Interroga in parallelo i tre servizi (gli errori sono restituiti come risultati)"""
+        return await asyncio.gather(
+            self.get_weather_data(lat, lon),
+            self.get_air_quality(lat, lon),
+            self.get_microbiome_data(taxa),
+            return_exceptions=True
+        )
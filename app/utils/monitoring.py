@@ -1,79 +1,228 @@
+import asyncio
 import logging
-from datetime import datetime
-from typing import Dict, Optional
+import math
+import os
+import time
+import msgspec
+import numpy as np
+from collections import Counter as TallyCounter, deque
+from typing import Awaitable, Callable, Deque, List, Optional, Sequence
+from cachetools import TTLCache
 from fastapi import Request
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, multiprocess
 from ..models import SecurityLog
 
-# Configurazione logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
+# Contatore dei campioni analizzati. Con PROMETHEUS_MULTIPROC_DIR impostato i valori
+# vivono in file mmap condivisi e la lettura aggrega tutti i worker
+SAMPLES_ANALYZED = Counter("samples_analyzed", "Campioni analizzati")
+
+def get_samples_analyzed() -> int:
+    """Restituisce il totale dei campioni analizzati"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return int(registry.get_sample_value("samples_analyzed_total") or 0)
+
+# Coda dei log di sicurezza: la richiesta accoda, un task in background scrive a batch
+LOG_QUEUE_MAXSIZE = 10_000
+LOG_BATCH_MAX = 500
+LOG_BATCH_WINDOW = 0.05  # secondi
+
+# Sentinella che chiede al writer di fermarsi dopo aver scritto quanto la precede
+_STOP = object()
+
+# Destinazione persistente dei log: riceve un intero batch per chiamata
+SecurityLogSink = Callable[[List[SecurityLog]], Awaitable[None]]
+
+# Limiti dello stato del monitor: con traffico ostile (molti IP distinti) la
+# memoria resta costante e le voci più vecchie scadono
+SECURITY_LOGS_MAX = 50_000
+TRACKED_IPS_MAX = 100_000
+SUSPICIOUS_IPS_TTL = 3600  # secondi
+FAILED_ATTEMPTS_TTL = 900  # secondi
+
+class AuditLogFile:
+    """Log di audit append-only su file (JSON lines), usabile come SecurityLogSink"""
+
+    def __init__(self, path: str):
+        self.path = path
+        # Aperto subito: nessuna apertura concorrente dai thread del pool
+        self._fd: Optional[int] = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        self._encoder = msgspec.json.Encoder()
+
+    def _append(self, data: bytes):
+        """Accoda i dati al file; eseguito in un thread del pool"""
+        if self._fd is None:
+            raise ValueError("Audit log file is closed")
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]
+
+    async def __call__(self, batch: List[SecurityLog]):
+        # Un solo buffer per batch: una write() invece di una per record
+        await asyncio.to_thread(self._append, self._encoder.encode_lines(batch))
+
+    def close(self):
+        """Chiude il file di audit (dopo l'arresto del writer, a scritture concluse)"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
 class SecurityMonitor:
     """Sistema di monitoraggio per la sicurezza"""
     
-    def __init__(self):
-        self.security_logs: List[SecurityLog] = []
-        self.suspicious_ips: Dict[str, int] = {}
-        self.failed_attempts: Dict[str, int] = {}
+    def __init__(self, sinks: Sequence[SecurityLogSink] = ()):
+        self.sinks = list(sinks)
+        self.security_logs: Deque[SecurityLog] = deque(maxlen=SECURITY_LOGS_MAX)
+        self.suspicious_ips: TTLCache = TTLCache(maxsize=TRACKED_IPS_MAX, ttl=SUSPICIOUS_IPS_TTL)
+        self.failed_attempts: TTLCache = TTLCache(maxsize=TRACKED_IPS_MAX, ttl=FAILED_ATTEMPTS_TTL)
+        self.dropped_logs = 0
+        self._queue: Optional[asyncio.Queue] = None
 
-    async def log_request(self, request: Request, user_id: str, event_type: str, details: str):
-        """Registra una richiesta nel log di sicurezza"""
-        client_ip = request.client.host if request.client else None
+    def log_request(self, request: Request, user_id: str, event_type: str, details: str):
+        """Registra una richiesta nel log di sicurezza senza bloccare la richiesta"""
+        client_ip = request.client.host if request and request.client else None
         
         log_entry = SecurityLog(
-            timestamp=datetime.utcnow(),
+            timestamp=time.time(),
             event_type=event_type,
             user_id=user_id,
             ip_address=client_ip,
             details=details
         )
         
-        self.security_logs.append(log_entry)
-        logger.info(f"Security Event: {event_type} - User: {user_id} - IP: {client_ip}")
+        # Senza writer attivo (es. fuori dal lifespan) si registra solo in memoria
+        if self._queue is None:
+            self._record_batch([log_entry])
+            return
+        try:
+            self._queue.put_nowait(log_entry)
+        except asyncio.QueueFull:
+            self.dropped_logs += 1
+
+    def _record_batch(self, batch: List[SecurityLog]):
+        """Registra un batch di log in memoria e nel logger"""
+        self.security_logs.extend(batch)
+        for entry in batch:
+            logger.info(
+                "Security Event: %s - User: %s - IP: %s",
+                entry.event_type, entry.user_id, entry.ip_address
+            )
+
+    async def _write_batch(self, batch: List[SecurityLog]):
+        """Scrive un batch di log di sicurezza, con una sola scrittura per destinazione"""
+        self._record_batch(batch)
+        for sink in self.sinks:
+            try:
+                await sink(batch)
+            except Exception:
+                logger.exception("Security log sink failed, %d entries lost", len(batch))
+
+    async def run(self):
+        """Task in background che svuota la coda dei log a batch"""
+        queue = self._queue = asyncio.Queue(maxsize=LOG_QUEUE_MAXSIZE)
+        stopping = False
+        try:
+            while not stopping:
+                item = await queue.get()
+                batch = [] if item is _STOP else [item]
+                stopping = item is _STOP
+                if not stopping and queue.empty():
+                    await asyncio.sleep(LOG_BATCH_WINDOW)
+                while not stopping and len(batch) < LOG_BATCH_MAX and not queue.empty():
+                    item = queue.get_nowait()
+                    if item is _STOP:
+                        stopping = True
+                    else:
+                        batch.append(item)
+                if batch:
+                    await self._write_batch(batch)
+        finally:
+            # Anche se il writer termina per errore o cancellazione: da qui si
+            # registra solo in memoria e si scrivono gli ultimi record accodati
+            self._queue = None
+            pending = []
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not _STOP:
+                    pending.append(item)
+            if pending:
+                await self._write_batch(pending)
+
+    async def stop(self):
+        """Ferma il writer dopo che ha scritto tutti i record già accodati"""
+        # _queue è None se il writer non è mai partito o è già terminato
+        queue = self._queue
+        if queue is None:
+            return
+        try:
+            queue.put_nowait(_STOP)
+        except asyncio.QueueFull:
+            # Il writer è attivo e sta svuotando la coda: si attende un posto
+            await queue.put(_STOP)
 
     def check_suspicious_activity(self, ip_address: str) -> bool:
         """Verifica se un IP mostra attività sospetta"""
-        if ip_address in self.suspicious_ips:
-            return self.suspicious_ips[ip_address] > 100  # soglia di richieste sospette
-        return False
+        return self.suspicious_ips.get(ip_address, 0) > 100  # soglia di richieste sospette
 
     def record_failed_attempt(self, ip_address: str):
         """Registra un tentativo fallito di autenticazione"""
-        if ip_address in self.failed_attempts:
-            self.failed_attempts[ip_address] += 1
-        else:
-            self.failed_attempts[ip_address] = 1
+        self.failed_attempts[ip_address] = self.failed_attempts.get(ip_address, 0) + 1
+
+# Numero di tempi di risposta recenti su cui si calcola la media
+RESPONSE_TIMES_WINDOW = 10_000
 
 class PerformanceMonitor:
     """Monitoraggio delle performance dell'API"""
     
     def __init__(self):
-        self.response_times: List[float] = []
-        self.error_counts: Dict[int, int] = {}  # status_code: count
+        # Buffer circolare float32 (4 byte per campione, niente float Python
+        # boxed) con somma aggiornata incrementalmente: media in O(1),
+        # percentili vettoriali con NumPy
+        self.response_times = np.empty(RESPONSE_TIMES_WINDOW, dtype=np.float32)
+        self._response_times_idx = 0
+        self._response_times_filled = 0
+        self._response_times_sum = 0.0
+        self.total_requests = 0
+        self.error_counts: TallyCounter = TallyCounter()  # status_code: count
 
     async def record_request(self, duration: float, status_code: int):
         """Registra i tempi di risposta e gli errori"""
-        self.response_times.append(duration)
+        idx = self._response_times_idx
+        if self._response_times_filled == RESPONSE_TIMES_WINDOW:
+            self._response_times_sum -= float(self.response_times[idx])
+        else:
+            self._response_times_filled += 1
+        self.response_times[idx] = duration
+        self._response_times_sum += float(self.response_times[idx])
+        self._response_times_idx = (idx + 1) % RESPONSE_TIMES_WINDOW
+        self.total_requests += 1
         
         if status_code >= 400:
-            if status_code in self.error_counts:
-                self.error_counts[status_code] += 1
-            else:
-                self.error_counts[status_code] = 1
+            self.error_counts[status_code] += 1
 
     def get_average_response_time(self) -> float:
         """Calcola il tempo medio di risposta"""
-        if not self.response_times:
+        if not self._response_times_filled:
+            return 0.0
+        return self._response_times_sum / self._response_times_filled
+
+    def get_p99(self) -> float:
+        """Calcola il 99° percentile dei tempi di risposta recenti"""
+        filled = self._response_times_filled
+        if not filled:
             return 0.0
-        return sum(self.response_times) / len(self.response_times)
+        # Nearest-rank: il più piccolo valore con almeno il 99% dei campioni <= esso
+        k = max(0, math.ceil(0.99 * filled) - 1)
+        return float(np.partition(self.response_times[:filled], k)[k])
 
     def get_error_rate(self) -> float:
         """Calcola il tasso di errore"""
         total_errors = sum(self.error_counts.values())
-        total_requests = len(self.response_times)
-        if total_requests == 0:
+        if self.total_requests == 0:
             return 0.0
-        return (total_errors / total_requests) * 100
\ No newline at end of file
+        return (total_errors / self.total_requests) * 100
\ No newline at end of file
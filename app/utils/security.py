@@ -1,71 +1,129 @@
+import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple, Union
+from cachetools import TTLCache
 from fastapi import HTTPException
 from cryptography.fernet import Fernet
 import os
+import time
+import uuid
+import hashlib
+from msgspec.structs import replace
+from functools import lru_cache
 from ..models import PlanTier, APIKeyModel
+from .subscription import PLAN_LIMITS
 
-# Configurazione logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@lru_cache(maxsize=1)
+def _get_cipher() -> Fernet:
+    """Cifrario Fernet condiviso dal processo (chiave letta e decodificata una volta)"""
+    key = os.environb.get(b"ENCRYPTION_KEY") or Fernet.generate_key()
+    return Fernet(key)
+
 class SecurityConfig:
     """Gestione della crittografia e sicurezza dei dati"""
     def __init__(self):
-        self.encryption_key = os.getenv("ENCRYPTION_KEY", Fernet.generate_key())
-        self.cipher_suite = Fernet(self.encryption_key)
+        self.cipher_suite = _get_cipher()
+
+    def encrypt_data(self, data: Union[bytes, str]) -> bytes:
+        """Cripta i dati sensibili (i bytes vengono usati senza copie di codifica)"""
+        if not isinstance(data, (bytes, bytearray)):
+            data = data.encode()
+        return self.cipher_suite.encrypt(bytes(data))
+
+    def decrypt_data(self, encrypted_data: Union[bytes, str]) -> bytes:
+        """Decripta i dati sensibili; il chiamante decodifica se gli serve una str"""
+        return self.cipher_suite.decrypt(encrypted_data)
+
+# Finestra scorrevole su sorted set Redis: rimozione delle richieste scadute,
+# conteggio e inserimento avvengono atomicamente in un solo round trip
+SLIDING_WINDOW_LUA = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local member = ARGV[4]
+
+redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+if redis.call('ZCARD', key) < limit then
+    redis.call('ZADD', key, now, member)
+    redis.call('PEXPIRE', key, window)
+    return 1
+end
+return 0
+"""
 
-    def encrypt_data(self, data: str) -> str:
-        """Cripta i dati sensibili"""
-        return self.cipher_suite.encrypt(data.encode()).decode()
+RATE_LIMIT_WINDOW = 30 * 24 * 3600  # finestra mensile (30 giorni), in secondi
+RATE_LIMIT_WINDOW_MS = RATE_LIMIT_WINDOW * 1000
 
-    def decrypt_data(self, encrypted_data: str) -> str:
-        """Decripta i dati sensibili"""
-        return self.cipher_suite.decrypt(encrypted_data.encode()).decode()
+# Bucket in memoria: un bucket inattivo per un'intera finestra è di nuovo pieno,
+# quindi la sua scadenza equivale a ricrearlo
+RATE_LIMIT_BUCKETS_MAX = 100_000
 
 class RateLimiter:
     """Gestione dei limiti di richieste per piano"""
-    def __init__(self):
-        self.requests: Dict[str, Dict] = {}
-        self.limits = {
-            PlanTier.BASIC: 1000,      # richieste al mese
-            PlanTier.PRO: 5000,        # richieste al mese
-            PlanTier.ENTERPRISE: 50000  # richieste al mese
+    def __init__(self, redis_client=None):
+        self.limits = PLAN_LIMITS  # richieste al mese
+        # Token bucket: capacità pari al limite mensile, ricarica continua (token/s)
+        self.refill_rates = {
+            plan: limit / RATE_LIMIT_WINDOW for plan, limit in self.limits.items()
         }
+        self.buckets: TTLCache = TTLCache(maxsize=RATE_LIMIT_BUCKETS_MAX, ttl=RATE_LIMIT_WINDOW)
+        # Con Redis il limite è condiviso tra tutti i worker, altrimenti è per processo
+        self._sliding_window = (
+            redis_client.register_script(SLIDING_WINDOW_LUA) if redis_client else None
+        )
 
-    async def check_rate_limit(self, api_key: str, api_keys: Dict) -> bool:
+    async def check_rate_limit(self, key_data: APIKeyModel) -> bool:
         """Verifica se l'API key ha superato il limite di richieste"""
-        if api_key not in api_keys:
+        limit = self.limits[key_data.plan]
+        if self._sliding_window is not None:
+            allowed = await self._sliding_window(
+                keys=[f"ratelimit:{key_data.user_id}"],
+                args=[int(time.time() * 1000), RATE_LIMIT_WINDOW_MS, limit, uuid.uuid4().hex]
+            )
+            return bool(allowed)
+
+        # Bucket per utente come la finestra Redis (e nessuna API key in chiaro
+        # come chiave); ricarica pigra: i token maturati si calcolano solo all'accesso
+        user_id = key_data.user_id
+        now = time.monotonic()
+        bucket: Tuple[float, float] = self.buckets.get(user_id, (limit, now))
+        tokens, last_refill = bucket
+        tokens = min(limit, tokens + (now - last_refill) * self.refill_rates[key_data.plan])
+        if tokens < 1:
+            self.buckets[user_id] = (tokens, now)
             return False
-            
-        user_data = api_keys[api_key]
-        current_month = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0)
-        
-        if api_key not in self.requests:
-            self.requests[api_key] = {"count": 0, "reset_time": current_month}
-            
-        if self.requests[api_key]["reset_time"] < current_month:
-            self.requests[api_key] = {"count": 0, "reset_time": current_month}
-            
-        self.requests[api_key]["count"] += 1
-        return self.requests[api_key]["count"] <= self.limits[user_data.plan]
+        self.buckets[user_id] = (tokens - 1, now)
+        return True
+
+def _hash_key(api_key: str) -> bytes:
+    """Digest BLAKE2b a 128 bit usato come chiave di lookup delle API key"""
+    return hashlib.blake2b(api_key.encode(), digest_size=16).digest()
+
+# Intervallo di scrittura degli ultimi utilizzi delle API key (secondi)
+LAST_USED_FLUSH_INTERVAL = 5
 
 class APIKeyManager:
     """Gestione delle API key"""
     def __init__(self):
-        self.api_keys: Dict[str, APIKeyModel] = {}
+        # Indicizzate per digest: il confronto avviene sull'hash, non sulla chiave in chiaro.
+        # Sul percorso di lettura i record non vengono modificati: gli ultimi utilizzi
+        # si accumulano in _last_used_pending e vengono applicati periodicamente
+        self.api_keys: Dict[bytes, APIKeyModel] = {}
+        self._last_used_pending: Dict[bytes, float] = {}
 
     def generate_api_key(self, user_id: str, plan: PlanTier) -> str:
         """Genera una nuova API key per un utente"""
         from secrets import token_urlsafe
         
         api_key = f"umapi_{token_urlsafe(32)}"
-        self.api_keys[api_key] = APIKeyModel(
+        self.api_keys[_hash_key(api_key)] = APIKeyModel(
             key=api_key,
             user_id=user_id,
             plan=plan,
-            created_at=datetime.utcnow(),
+            created_at=time.time(),
             is_active=True,
             last_used=None
         )
@@ -73,19 +131,36 @@ class APIKeyManager:
 
     def validate_api_key(self, api_key: str) -> Optional[APIKeyModel]:
         """Valida un'API key"""
-        if api_key not in self.api_keys:
-            return None
-        
-        key_data = self.api_keys[api_key]
-        if not key_data.is_active:
+        key_hash = _hash_key(api_key)
+        key_data = self.api_keys.get(key_hash)
+        if key_data is None or not key_data.is_active:
             return None
             
-        key_data.last_used = datetime.utcnow()
+        self._last_used_pending[key_hash] = time.time()
         return key_data
 
+    def flush_last_used(self):
+        """Applica ai record delle API key gli ultimi utilizzi accumulati"""
+        pending, self._last_used_pending = self._last_used_pending, {}
+        for key_hash, last_used in pending.items():
+            key_data = self.api_keys.get(key_hash)
+            if key_data is not None:
+                self.api_keys[key_hash] = replace(key_data, last_used=last_used)
+
+    async def run(self):
+        """Task in background che scrive periodicamente gli ultimi utilizzi"""
+        try:
+            while True:
+                await asyncio.sleep(LAST_USED_FLUSH_INTERVAL)
+                self.flush_last_used()
+        finally:
+            self.flush_last_used()
+
     def deactivate_api_key(self, api_key: str) -> bool:
         """Disattiva un'API key"""
-        if api_key in self.api_keys:
-            self.api_keys[api_key].is_active = False
-            return True
-        return False
\ No newline at end of file
+        key_hash = _hash_key(api_key)
+        key_data = self.api_keys.get(key_hash)
+        if key_data is None:
+            return False
+        self.api_keys[key_hash] = replace(key_data, is_active=False)
+        return True
\ No newline at end of file
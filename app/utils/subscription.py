@@ -1,27 +1,37 @@
-from datetime import datetime, timedelta
+import time
+from types import MappingProxyType
+from typing import Callable, Mapping
 from ..models import UserSubscription, SubscriptionUsage, PlanTier
 
+# Richieste mensili incluse in ciascun piano (tabella immutabile condivisa)
+PLAN_LIMITS: Mapping[PlanTier, int] = MappingProxyType({
+    PlanTier.BASIC: 1000,
+    PlanTier.PRO: 5000,
+    PlanTier.ENTERPRISE: 50000
+})
+
+# Funzioni specializzate per piano, generate all'avvio: il limite è una
+# costante della closure invece di una ricerca nella tabella a ogni chiamata
+def _make_check(limit: int) -> Callable[[UserSubscription], bool]:
+    def check(subscription: UserSubscription) -> bool:
+        return subscription.requests_used < limit
+    return check
+
+def _make_usage(limit: int) -> Callable[[UserSubscription], SubscriptionUsage]:
+    def usage(subscription: UserSubscription) -> SubscriptionUsage:
+        return SubscriptionUsage(
+            requests_used=subscription.requests_used,
+            requests_limit=limit,
+            remaining_requests=limit - subscription.requests_used,
+            days_until_renewal=int((subscription.current_period_end_ts - time.time()) // 86400)
+        )
+    return usage
+
+_CHECKS = {tier: _make_check(limit) for tier, limit in PLAN_LIMITS.items()}
+_USAGES = {tier: _make_usage(limit) for tier, limit in PLAN_LIMITS.items()}
+
 def check_subscription_limits(subscription: UserSubscription) -> bool:
-    plan_limits = {
-        PlanTier.BASIC: 1000,
-        PlanTier.PRO: 5000,
-        PlanTier.ENTERPRISE: 50000
-    }
-    return subscription.requests_used < plan_limits[subscription.plan]
+    return _CHECKS[subscription.plan](subscription)
 
 def get_subscription_usage(subscription: UserSubscription) -> SubscriptionUsage:
-    plan_limits = {
-        PlanTier.BASIC: 1000,
-        PlanTier.PRO: 5000,
-        PlanTier.ENTERPRISE: 50000
-    }
-    limit = plan_limits[subscription.plan]
-    remaining = limit - subscription.requests_used
-    days_until = (subscription.current_period_end - datetime.utcnow()).days
-    
-    return SubscriptionUsage(
-        requests_used=subscription.requests_used,
-        requests_limit=limit,
-        remaining_requests=remaining,
-        days_until_renewal=days_until
-    )
\ No newline at end of file
+    return _USAGES[subscription.plan](subscription)
\ No newline at end of file